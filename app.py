@@ -1,14 +1,24 @@
 from flask import Flask, render_template, redirect, url_for, flash, request, jsonify
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from models import db, User, Listing, Booking, Review, Amenity, TrafficArea, AvailableSlot
+from models import (db, User, Listing, Booking, ArchivedBooking, BookingRollup, Review, Amenity,
+                    TrafficArea, AvailableSlot, ACTIVE_BOOKING_STATUSES)
+from maintenance import expire_pending_bookings, archive_old_bookings, run_booking_sweeper, start_booking_sweeper
+import click
 import datetime
 import math
+import os
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'dev_secret_key_123' # Change for production
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///parkshare.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['BOOKING_HOLD_MINUTES'] = int(os.environ.get('BOOKING_HOLD_MINUTES', 15)) # Unpaid bookings expire after this
+app.config['BOOKING_SWEEP_INTERVAL_SECONDS'] = int(os.environ.get('BOOKING_SWEEP_INTERVAL_SECONDS', 60))
+app.config['BOOKING_SWEEP_BATCH_SIZE'] = int(os.environ.get('BOOKING_SWEEP_BATCH_SIZE', 500))
+app.config['BOOKING_SWEEPER_ENABLED'] = os.environ.get('BOOKING_SWEEPER_ENABLED', '1') == '1' # Set to 0 when running the CLI worker
+app.config['BOOKING_ARCHIVE_AFTER_DAYS'] = int(os.environ.get('BOOKING_ARCHIVE_AFTER_DAYS', 90))
+app.config['HISTORY_ARCHIVE_PAGE_SIZE'] = 20
 
 db.init_app(app)
 login_manager = LoginManager()
@@ -47,6 +57,19 @@ def init_traffic_areas():
             db.session.add(new_area)
     db.session.commit()
 
+def create_missing_indexes():
+    """Create indexes added to tables that already exist; create_all() skips those"""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+def init_db():
+    """Create missing tables and indexes and seed default data"""
+    db.create_all()
+    create_missing_indexes()
+    init_amenities() # Initialize default amenities
+    init_traffic_areas() # Initialize traffic areas
+
 def calculate_distance(lat1, lon1, lat2, lon2):
     """Calculate distance between two points in km (Haversine formula)"""
     R = 6371  # Earth radius in km
@@ -120,6 +143,38 @@ def find_nearby_parking(search_location_lat, search_location_lon, search_area_na
     nearby_listings.sort(key=lambda x: x['distance'])
     return nearby_listings[:10]  # Return top 10 nearest
 
+def get_booking_totals(listing_ids, status='confirmed', payment_status=None):
+    """Sum earnings, bookings and hours per listing across live and archived bookings"""
+    totals = {listing_id: {'total': 0.0, 'count': 0, 'hours': 0.0} for listing_id in listing_ids}
+    if not listing_ids:
+        return totals
+
+    live = db.session.query(
+        Booking.listing_id,
+        db.func.count(Booking.id),
+        db.func.sum(Booking.total_price),
+        db.func.sum(db.func.julianday(Booking.end_time) - db.func.julianday(Booking.start_time)) * 24
+    ).filter(Booking.listing_id.in_(listing_ids), Booking.status == status)
+    rollups = BookingRollup.query.filter(
+        BookingRollup.listing_id.in_(listing_ids),
+        BookingRollup.status == status
+    )
+    if payment_status is not None:
+        live = live.filter(Booking.payment_status == payment_status)
+        rollups = rollups.filter(BookingRollup.payment_status == payment_status)
+
+    for listing_id, count, total_price, hours in live.group_by(Booking.listing_id):
+        totals[listing_id]['total'] += total_price or 0.0
+        totals[listing_id]['count'] += count
+        totals[listing_id]['hours'] += hours or 0.0
+
+    for rollup in rollups:
+        totals[rollup.listing_id]['total'] += rollup.total_price
+        totals[rollup.listing_id]['count'] += rollup.booking_count
+        totals[rollup.listing_id]['hours'] += rollup.total_hours
+
+    return totals
+
 @app.route('/')
 def index():
     amenities = Amenity.query.all()
@@ -177,36 +232,25 @@ def dashboard():
         return redirect(url_for('index'))
     
     listings = Listing.query.filter_by(host_id=current_user.id).all()
+    listing_ids = [l.id for l in listings]
     
-    # Calculate earnings from completed bookings
-    completed_bookings = Booking.query.filter(
-        Booking.listing_id.in_([l.id for l in listings]),
-        Booking.status == 'confirmed',
-        Booking.payment_status == 'paid'
-    ).all()
+    # Calculate earnings from completed bookings, including archived ones
+    paid_totals = get_booking_totals(listing_ids, payment_status='paid')
     
-    total_earnings = sum(booking.total_price for booking in completed_bookings)
+    total_earnings = sum(t['total'] for t in paid_totals.values())
     
     # Calculate stats
-    total_bookings = len(completed_bookings)
-    total_hours = sum(
-        (booking.end_time - booking.start_time).total_seconds() / 3600 
-        for booking in completed_bookings
-    )
+    total_bookings = sum(t['count'] for t in paid_totals.values())
+    total_hours = sum(t['hours'] for t in paid_totals.values())
     
     # Get ratings
     all_reviews = Review.query.filter(
-        Review.listing_id.in_([l.id for l in listings])
+        Review.listing_id.in_(listing_ids)
     ).all()
     avg_rating = sum(r.rating for r in all_reviews) / len(all_reviews) if all_reviews else 0
     
-    earnings_breakdown = {}
-    for listing in listings:
-        listing_bookings = Booking.query.filter(
-            Booking.listing_id == listing.id,
-            Booking.status == 'confirmed'
-        ).all()
-        earnings_breakdown[listing.id] = sum(b.total_price for b in listing_bookings)
+    confirmed_totals = get_booking_totals(listing_ids)
+    earnings_breakdown = {listing_id: t['total'] for listing_id, t in confirmed_totals.items()}
     
     return render_template(
         'dashboard.html',
@@ -372,7 +416,7 @@ def book(listing_id):
         # Conflict Detection
         overlapping_bookings = Booking.query.filter(
             Booking.listing_id == listing.id,
-            Booking.status != 'cancelled',
+            Booking.holds_slot(app.config['BOOKING_HOLD_MINUTES']),
             Booking.end_time > start_time,
             Booking.start_time < end_time
         ).first()
@@ -406,12 +450,23 @@ def payment(booking_id):
     booking = Booking.query.get_or_404(booking_id)
     if booking.user_id != current_user.id or booking.status != 'pending':
         return redirect(url_for('dashboard'))
+
+    hold_cutoff = datetime.datetime.utcnow() - datetime.timedelta(minutes=app.config['BOOKING_HOLD_MINUTES'])
+    if booking.created_at < hold_cutoff:
+        flash('Your booking hold has expired. Please book again.')
+        return redirect(url_for('book', listing_id=booking.listing_id))
         
     if request.method == 'POST':
         # Simulate Payment Processing
-        booking.status = 'confirmed'
-        booking.payment_status = 'paid'
+        # Only confirm if the sweeper has not expired the booking in the meantime
+        confirmed = Booking.query.filter_by(id=booking.id, status='pending').update(
+            {'status': 'confirmed', 'payment_status': 'paid'},
+            synchronize_session=False
+        )
         db.session.commit()
+        if not confirmed:
+            flash('Your booking hold has expired. Please book again.')
+            return redirect(url_for('book', listing_id=booking.listing_id))
         flash('Payment successful! Booking confirmed.')
         return redirect(url_for('history'))
         
@@ -421,7 +476,7 @@ def payment(booking_id):
 @login_required
 def cancel_booking(booking_id):
     booking = Booking.query.get_or_404(booking_id)
-    if booking.user_id != current_user.id:
+    if booking.user_id != current_user.id or booking.status not in ACTIVE_BOOKING_STATUSES:
         return redirect(url_for('history'))
         
     if booking.start_time > datetime.datetime.utcnow():
@@ -438,7 +493,30 @@ def cancel_booking(booking_id):
 @login_required
 def history():
     bookings = Booking.query.filter_by(user_id=current_user.id).order_by(Booking.start_time.desc()).all()
-    return render_template('history.html', bookings=bookings, now=datetime.datetime.utcnow())
+    
+    # Older bookings live in the archive and are only loaded page by page on request
+    archive_page = request.args.get('archive_page', 0, type=int)
+    archived_bookings = []
+    if archive_page > 0:
+        per_page = app.config['HISTORY_ARCHIVE_PAGE_SIZE']
+        archived_bookings = ArchivedBooking.query.filter_by(user_id=current_user.id).order_by(
+            ArchivedBooking.start_time.desc()
+        ).offset((archive_page - 1) * per_page).limit(per_page + 1).all()
+        has_more_archive = len(archived_bookings) > per_page
+        archived_bookings = archived_bookings[:per_page]
+    else:
+        has_more_archive = db.session.query(ArchivedBooking.id).filter_by(
+            user_id=current_user.id
+        ).first() is not None
+    
+    return render_template(
+        'history.html',
+        bookings=bookings,
+        archived_bookings=archived_bookings,
+        archive_page=archive_page,
+        has_more_archive=has_more_archive,
+        now=datetime.datetime.utcnow()
+    )
             
 @app.route('/add_review/<int:listing_id>', methods=['POST'])
 @login_required
@@ -461,7 +539,13 @@ def profile():
         db.session.commit()
         flash('Profile updated!')
         return redirect(url_for('profile'))
-    return render_template('profile.html')
+    
+    # Count archived bookings too so the total doesn't drop after archiving
+    booking_count = (
+        Booking.query.filter_by(user_id=current_user.id).count()
+        + ArchivedBooking.query.filter_by(user_id=current_user.id).count()
+    )
+    return render_template('profile.html', booking_count=booking_count)
 
 # ============== API Routes for AJAX ==============
 
@@ -507,19 +591,13 @@ def api_earnings(listing_id):
     if listing.host_id != current_user.id:
         return jsonify({'error': 'Unauthorized'}), 403
     
-    bookings = Booking.query.filter(
-        Booking.listing_id == listing_id,
-        Booking.status == 'confirmed'
-    ).all()
-    
-    total = sum(b.total_price for b in bookings)
-    hours = sum((b.end_time - b.start_time).total_seconds() / 3600 for b in bookings)
+    totals = get_booking_totals([listing_id])[listing_id]
     
     return jsonify({
         'listing_id': listing_id,
-        'total_earnings': round(total, 2),
-        'total_bookings': len(bookings),
-        'total_hours': round(hours, 1),
+        'total_earnings': round(totals['total'], 2),
+        'total_bookings': totals['count'],
+        'total_hours': round(totals['hours'], 1),
         'average_rate': listing.hourly_rate
     })
 
@@ -544,11 +622,45 @@ def api_all_traffic_areas():
     
     return jsonify(result)
 
+# ============== CLI Commands ==============
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create or upgrade the database schema"""
+    init_db()
+    click.echo('Database initialized.')
+
+@app.cli.command('expire-bookings')
+@click.option('--loop', is_flag=True, help='Keep running as a worker instead of sweeping once.')
+def expire_bookings_command(loop):
+    """Expire pending bookings that were never paid for"""
+    init_db()
+    if loop:
+        run_booking_sweeper(app)
+    else:
+        count = expire_pending_bookings(
+            hold_minutes=app.config['BOOKING_HOLD_MINUTES'],
+            batch_size=app.config['BOOKING_SWEEP_BATCH_SIZE']
+        )
+        click.echo(f'Expired {count} pending bookings.')
+
+@app.cli.command('archive-bookings')
+@click.option('--days', type=int, default=None, help='Archive bookings that ended more than this many days ago.')
+def archive_bookings_command(days):
+    """Move old finished bookings out of the live booking table"""
+    init_db()
+    count = archive_old_bookings(
+        older_than_days=days if days is not None else app.config['BOOKING_ARCHIVE_AFTER_DAYS'],
+        batch_size=app.config['BOOKING_SWEEP_BATCH_SIZE']
+    )
+    click.echo(f'Archived {count} bookings.')
+
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
-        init_amenities() # Initialize default amenities
-        init_traffic_areas() # Initialize traffic areas
+        init_db()
+    # app.run(debug=True) uses the reloader; only its child process serves requests
+    if app.config['BOOKING_SWEEPER_ENABLED'] and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_booking_sweeper(app)
     print("Starting ParkShare application...")
     app.run(debug=True)
 
@@ -0,0 +1,189 @@
+import datetime
+import threading
+
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Booking, ArchivedBooking, BookingRollup
+
+# Bookings in these states never change again and can leave the live table
+ARCHIVABLE_BOOKING_STATUSES = ('confirmed', 'cancelled', 'expired')
+
+
+def expire_pending_bookings(hold_minutes=15, batch_size=500):
+    """Mark pending bookings older than the hold window as expired.
+
+    Works in small batches so a large backlog never holds the SQLite write
+    lock for long. Every UPDATE re-checks status and age, so several workers
+    sweeping at once can only ever expire the same rows once.
+    Returns the number of bookings expired.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(minutes=hold_minutes)
+    expired = 0
+
+    while True:
+        ids = [row.id for row in db.session.query(Booking.id).filter(
+            Booking.status == 'pending',
+            Booking.created_at < cutoff
+        ).order_by(Booking.id).limit(batch_size).all()]
+
+        if not ids:
+            break
+
+        result = db.session.execute(
+            update(Booking)
+            .where(
+                Booking.id.in_(ids),
+                Booking.status == 'pending',
+                Booking.created_at < cutoff
+            )
+            .values(status='expired')
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        expired += result.rowcount
+
+        if len(ids) < batch_size:
+            break
+
+    return expired
+
+
+def archive_old_bookings(older_than_days=90, batch_size=500, max_conflicts=3):
+    """Move finished bookings that ended before the cutoff into the archive.
+
+    Each batch deletes the rows from Booking, copies them into ArchivedBooking
+    and adds them to the per-listing BookingRollup totals in one transaction,
+    so earnings stay the same before and after archiving. The DELETE re-checks
+    status and age; if it removes fewer rows than were selected, another worker
+    got there first and the batch is rolled back and selected again. Rollups
+    are incremented in SQL so concurrent archivers never lose an update.
+    Returns the number of bookings archived.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=older_than_days)
+    archived = 0
+    conflicts = 0
+
+    while True:
+        with db.session.no_autoflush:
+            batch = Booking.query.filter(
+                Booking.status.in_(ARCHIVABLE_BOOKING_STATUSES),
+                Booking.end_time < cutoff
+            ).order_by(Booking.id).limit(batch_size).all()
+
+            if not batch:
+                break
+
+            ids = [booking.id for booking in batch]
+            result = db.session.execute(
+                delete(Booking)
+                .where(
+                    Booking.id.in_(ids),
+                    Booking.status.in_(ARCHIVABLE_BOOKING_STATUSES),
+                    Booking.end_time < cutoff
+                )
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount != len(ids):
+                db.session.rollback()
+                conflicts += 1
+                if conflicts > max_conflicts:
+                    raise RuntimeError('Bookings kept changing while being archived')
+                continue
+
+            totals = {}
+            for booking in batch:
+                db.session.add(ArchivedBooking(
+                    booking_id=booking.id,
+                    start_time=booking.start_time,
+                    end_time=booking.end_time,
+                    total_price=booking.total_price,
+                    status=booking.status,
+                    payment_status=booking.payment_status,
+                    user_id=booking.user_id,
+                    listing_id=booking.listing_id,
+                    created_at=booking.created_at
+                ))
+                key = (booking.listing_id, booking.status, booking.payment_status)
+                count, price, hours = totals.get(key, (0, 0.0, 0.0))
+                totals[key] = (
+                    count + 1,
+                    price + booking.total_price,
+                    hours + (booking.end_time - booking.start_time).total_seconds() / 3600
+                )
+            # The rows were deleted in SQL; drop their stale copies from the session
+            for booking in batch:
+                db.session.expunge(booking)
+
+            for (listing_id, status, payment_status), (count, price, hours) in totals.items():
+                result = db.session.execute(
+                    update(BookingRollup)
+                    .where(
+                        BookingRollup.listing_id == listing_id,
+                        BookingRollup.status == status,
+                        BookingRollup.payment_status == payment_status
+                    )
+                    .values(
+                        booking_count=BookingRollup.booking_count + count,
+                        total_price=BookingRollup.total_price + price,
+                        total_hours=BookingRollup.total_hours + hours
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+                if result.rowcount == 0:
+                    db.session.add(BookingRollup(
+                        listing_id=listing_id, status=status, payment_status=payment_status,
+                        booking_count=count, total_price=price, total_hours=hours
+                    ))
+
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another archiver inserted the same new rollup row first
+            db.session.rollback()
+            conflicts += 1
+            if conflicts > max_conflicts:
+                raise
+            continue
+        archived += len(batch)
+        conflicts = 0
+
+        if len(batch) < batch_size:
+            break
+
+    return archived
+
+
+def run_booking_sweeper(app, stop_event=None):
+    """Loop forever expiring stale pending bookings using the app config"""
+    interval = app.config.get('BOOKING_SWEEP_INTERVAL_SECONDS', 60)
+    stop_event = stop_event or threading.Event()
+
+    while not stop_event.is_set():
+        with app.app_context():
+            try:
+                count = expire_pending_bookings(
+                    hold_minutes=app.config.get('BOOKING_HOLD_MINUTES', 15),
+                    batch_size=app.config.get('BOOKING_SWEEP_BATCH_SIZE', 500)
+                )
+                if count:
+                    app.logger.info('Expired %d abandoned pending bookings', count)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('Booking sweep failed')
+            finally:
+                db.session.remove()
+        stop_event.wait(interval)
+
+
+def start_booking_sweeper(app):
+    """Start the booking sweeper in a daemon thread inside this process"""
+    stop_event = threading.Event()
+    thread = threading.Thread(
+        target=run_booking_sweeper,
+        args=(app, stop_event),
+        name='booking-sweeper',
+        daemon=True
+    )
+    thread.start()
+    return stop_event
@@ -1,10 +1,14 @@
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from datetime import datetime
+from datetime import datetime, timedelta
 import math
 
 db = SQLAlchemy()
 
+# Bookings in these states hold their time slot; cancelled and expired ones do not
+ACTIVE_BOOKING_STATUSES = ('pending', 'confirmed')
+
 listing_amenities = db.Table('listing_amenities',
     db.Column('listing_id', db.Integer, db.ForeignKey('listing.id'), primary_key=True),
     db.Column('amenity_id', db.Integer, db.ForeignKey('amenity.id'), primary_key=True)
@@ -63,13 +67,61 @@ class Booking(db.Model):
     start_time = db.Column(db.DateTime, nullable=False)
     end_time = db.Column(db.DateTime, nullable=False)
     total_price = db.Column(db.Float, nullable=False)
-    status = db.Column(db.String(20), default='pending') # pending, confirmed, cancelled
+    status = db.Column(db.String(20), default='pending') # pending, confirmed, cancelled, expired
     payment_status = db.Column(db.String(20), default='unpaid') # unpaid, paid, refunded
     
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     listing_id = db.Column(db.Integer, db.ForeignKey('listing.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_booking_status_created_at', 'status', 'created_at'), # Pending-booking sweeper
+        db.Index('ix_booking_status_end_time', 'status', 'end_time'), # Booking archiver
+    )
+
+    @classmethod
+    def holds_slot(cls, hold_minutes):
+        """Filter for bookings that still block their time slot.
+
+        Pending bookings stop counting once their hold window has passed,
+        even if the sweeper has not marked them expired yet.
+        """
+        hold_cutoff = datetime.utcnow() - timedelta(minutes=hold_minutes)
+        return db.or_(
+            cls.status == 'confirmed',
+            db.and_(cls.status == 'pending', cls.created_at >= hold_cutoff)
+        )
+
+class ArchivedBooking(db.Model):
+    """Finished or cancelled bookings moved out of the live booking table"""
+    id = db.Column(db.Integer, primary_key=True)
+    booking_id = db.Column(db.Integer, nullable=False, index=True) # Id the booking had while live; SQLite may reuse it
+    start_time = db.Column(db.DateTime, nullable=False)
+    end_time = db.Column(db.DateTime, nullable=False)
+    total_price = db.Column(db.Float, nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    payment_status = db.Column(db.String(20), nullable=False)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    listing_id = db.Column(db.Integer, db.ForeignKey('listing.id'), nullable=False)
+    created_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    listing = db.relationship('Listing')
+
+    __table_args__ = (
+        db.Index('ix_archived_booking_user_start', 'user_id', 'start_time'), # History paging
+    )
+
+class BookingRollup(db.Model):
+    """Running totals of archived bookings per listing, status and payment status"""
+    listing_id = db.Column(db.Integer, db.ForeignKey('listing.id'), primary_key=True)
+    status = db.Column(db.String(20), primary_key=True)
+    payment_status = db.Column(db.String(20), primary_key=True)
+    booking_count = db.Column(db.Integer, default=0, nullable=False)
+    total_price = db.Column(db.Float, default=0.0, nullable=False)
+    total_hours = db.Column(db.Float, default=0.0, nullable=False)
+
 class TrafficArea(db.Model):
     """Represents major parking areas (e.g., Market Square, Downtown)"""
     id = db.Column(db.Integer, primary_key=True)
@@ -116,7 +168,7 @@ class AvailableSlot(db.Model):
         # Check for overlapping bookings
         overlapping = Booking.query.filter(
             Booking.listing_id == self.listing_id,
-            Booking.status != 'cancelled',
+            Booking.holds_slot(current_app.config.get('BOOKING_HOLD_MINUTES', 15)),
             Booking.end_time > self.start_time,
             Booking.start_time < self.end_time
         ).first()